@@ -1,38 +1,1414 @@
 import strawberry
 import uvicorn
-from fastapi import FastAPI
-from strawberry.fastapi import GraphQLRouter
-import typing 
-import psycopg2
+from fastapi import FastAPI, HTTPException, Request
+from fastapi import Query as QueryParam  # the schema defines its own Query type
+from fastapi.responses import StreamingResponse, JSONResponse, FileResponse, Response
+from starlette.background import BackgroundTask
+from strawberry.fastapi import GraphQLRouter, BaseContext
+from strawberry.types import Info
+from strawberry.types.nodes import SelectedField
+from strawberry.types import ExecutionResult
+from strawberry.extensions import ParserCache, ValidationCache, SchemaExtension, AddValidationRules, QueryDepthLimiter
+from strawberry.extensions.tracing.utils import should_skip_tracing
+from strawberry.http import GraphQLRequestData
+from graphql import GraphQLError, ValidationRule, FieldNode, InlineFragmentNode, FragmentSpreadNode, IntValueNode
+from graphql import get_named_type, get_nullable_type, is_list_type, get_operation_ast
+from strawberry.dataloader import DataLoader
+import typing
+import functools
+import base64
+import dataclasses
+import enum
+import json
+import uuid
+import random
+import time
+import collections
+import contextlib
+import re
+import contextvars
+import inspect
+import hashlib
+import csv
+import decimal
+import math
+import tempfile
+import pyarrow
+import pyarrow.parquet
+import psycopg
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
 import os
 from fastapi.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager
+import asyncio
+import gc
+import threading
+import traceback
+import sys
+from gunicorn.app.base import BaseApplication
+import prometheus_client
+from prometheus_client import multiprocess, Counter, Histogram
+from opentelemetry import trace
+from opentelemetry.trace import SpanKind, Status, StatusCode
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
 
-try:
-    conn = psycopg2.connect(
-        host=os.environ.get('PG_HOST'),
-        port= os.environ.get('PG_PORT'),
-        database=os.environ.get('PG_DATABASE'),
-        user=os.environ.get('PG_USER'),
-        password=os.environ.get('PG_PASSWORD')
+DATABASE_URL = os.environ.get('DATABASE_URL', '')
+
+POOL_MIN_SIZE = int(os.environ.get('PG_POOL_MIN_SIZE', 2))
+POOL_MAX_SIZE = int(os.environ.get('PG_POOL_MAX_SIZE', 10))
+POOL_TIMEOUT = float(os.environ.get('PG_POOL_TIMEOUT', 30))
+# Worker processes of the production launcher. Every worker opens its own
+# pool, so Postgres sees up to WEB_CONCURRENCY * PG_POOL_MAX_SIZE connections.
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 1))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 100))
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', 1000))
+# Largest chunk_size a /stream client may ask for; a chunk is held in memory.
+STREAM_MAX_CHUNK_SIZE = int(os.environ.get('STREAM_MAX_CHUNK_SIZE', 10000))
+ENTITY_CACHE_SIZE = int(os.environ.get('ENTITY_CACHE_SIZE', 10000))
+ENTITY_CACHE_TTL = float(os.environ.get('ENTITY_CACHE_TTL', 60))
+DOCUMENT_CACHE_SIZE = int(os.environ.get('DOCUMENT_CACHE_SIZE', 1000))
+PERSISTED_QUERY_CACHE_SIZE = int(os.environ.get('PERSISTED_QUERY_CACHE_SIZE', 1000))
+ENTITY_CACHE_PREWARM = [t for t in os.environ.get('ENTITY_CACHE_PREWARM', '').split(',') if t]
+# Server-side prepared statements live on one backend connection, so turn
+# this off when running behind a transaction-pooling pgbouncer. Off also
+# disables psycopg's automatic preparing of repeated queries.
+PREPARE_STATEMENTS = os.environ.get('PG_PREPARE_STATEMENTS', '1') == '1'
+PREPARED_MAX = int(os.environ.get('PG_PREPARED_MAX', 200))
+BULK_INSERT_CHUNK_SIZE = int(os.environ.get('BULK_INSERT_CHUNK_SIZE', 1000))
+IMPORT_MAX_ERRORS = int(os.environ.get('IMPORT_MAX_ERRORS', 100))
+# Longest CSV or NDJSON record an import accepts. A longer one, such as
+# everything after a stray quote, fails on its own instead of being buffered.
+IMPORT_MAX_RECORD_BYTES = int(os.environ.get('IMPORT_MAX_RECORD_BYTES', 1048576))
+EXPORT_CHUNK_BYTES = int(os.environ.get('EXPORT_CHUNK_BYTES', 65536))
+ARROW_BATCH_SIZE = int(os.environ.get('ARROW_BATCH_SIZE', 65536))
+PG_CONNECT_ATTEMPTS = int(os.environ.get('PG_CONNECT_ATTEMPTS', 5))
+PG_BACKOFF_BASE = float(os.environ.get('PG_BACKOFF_BASE', 0.5))
+PG_BACKOFF_MAX = float(os.environ.get('PG_BACKOFF_MAX', 10))
+# How long `python3 baseapi.py migrate` waits for the database to come up.
+PG_MIGRATE_TIMEOUT = float(os.environ.get('PG_MIGRATE_TIMEOUT', 60))
+# Pooled connections idle for longer than this are pinged before use.
+PG_PREPING_IDLE = float(os.environ.get('PG_PREPING_IDLE', 5))
+PG_HEALTH_CHECK_INTERVAL = float(os.environ.get('PG_HEALTH_CHECK_INTERVAL', 30))
+HEALTH_CHECK_TIMEOUT = float(os.environ.get('HEALTH_CHECK_TIMEOUT', 2))
+# Spans go to the collector at OTEL_EXPORTER_OTLP_ENDPOINT (default
+# http://localhost:4318).
+TRACING = os.environ.get('TRACING', '0') == '1'
+# 0 turns the slow-query log off.
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+MAX_QUERY_DEPTH = int(os.environ.get('MAX_QUERY_DEPTH', 10))
+MAX_QUERY_COST = int(os.environ.get('MAX_QUERY_COST', 10000))
+# rows the cost rule assumes for a relationship list such as
+# Employee.insurances; those lists are not limited, so this is an estimate
+QUERY_LIST_SIZE = int(os.environ.get('QUERY_LIST_SIZE', 100))
+# largest limit of the all_* lists, and the rows the cost rule counts for
+# one that has no limit
+MAX_LIST_SIZE = int(os.environ.get('MAX_LIST_SIZE', 10000))
+# changes buffered per subscriber before a slow one is disconnected
+SUBSCRIPTION_QUEUE_SIZE = int(os.environ.get('SUBSCRIPTION_QUEUE_SIZE', 1000))
+# 0 turns the event-loop watchdog off.
+LOOP_STALL_MS = float(os.environ.get('LOOP_STALL_MS', 100))
+
+# With WEB_CONCURRENCY > 1 set PROMETHEUS_MULTIPROC_DIR to an empty directory
+# so that /metrics aggregates the samples of every worker.
+OPERATION_SECONDS = Histogram("graphql_operation_seconds", "GraphQL operation latency", ["operation"])
+OPERATION_ERRORS = Counter("graphql_operation_errors_total", "GraphQL operations answered with errors", ["operation"])
+RESOLVER_SECONDS = Histogram("graphql_resolver_seconds", "Resolver latency", ["resolver"])
+RESOLVER_ERRORS = Counter("graphql_resolver_errors_total", "Resolvers that raised", ["resolver"])
+DB_QUERY_SECONDS = Histogram("db_query_seconds", "SQL execution time", ["resolver"])
+DB_ROWS = Counter("db_rows_total", "Rows fetched from the database", ["resolver"])
+DB_POOL_WAIT_SECONDS = Histogram("db_pool_wait_seconds", "Time spent waiting for a pooled connection")
+
+# resolver that SQL time and rows are attributed to; "-" outside GraphQL
+current_resolver = contextvars.ContextVar("current_resolver", default="-")
+
+tracer = trace.get_tracer("baseapi")
+
+def configure_tracing() -> TracerProvider:
+    """Export spans over OTLP. Called from lifespan so that every worker
+    process starts its own export thread."""
+    provider = TracerProvider(resource=Resource.create({"service.name": os.environ.get("OTEL_SERVICE_NAME", "baseapi")}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    return provider
+
+@functools.lru_cache(maxsize=1024)
+def normalize_sql(statement: str) -> str:
+    """Statement text with string and number literals replaced by ``?`` and
+    the whitespace collapsed, so that it is safe to log and groups well."""
+    statement = re.sub(r"'(?:[^']|'')*'", "?", statement)
+    statement = re.sub(r"\b\d+(?:\.\d+)?\b", "?", statement)
+    return " ".join(statement.split())
+
+def redact(params) -> typing.Any:
+    if isinstance(params, dict):
+        return {key: type(value).__name__ for key, value in params.items()}
+    return [type(value).__name__ for value in params or ()]
+
+class MeteredCursorMixin:
+    """Records execution time and fetched rows of every statement under the
+    resolver that issued it. Traces each statement as a child span of that
+    resolver and logs the ones slower than SLOW_QUERY_MS, with the parameter
+    values replaced by their types."""
+
+    async def execute(self, query, params=None, **kwargs):
+        statement = query if isinstance(query, str) else query.as_string(self)
+        span = contextlib.nullcontext()
+        if TRACING:
+            attributes = {"db.system": "postgresql", "db.statement": normalize_sql(statement)}
+            span = tracer.start_as_current_span("SQL", kind=SpanKind.CLIENT, attributes=attributes)
+        start = time.perf_counter()
+        try:
+            with span:
+                return await super().execute(query, params, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            resolver = current_resolver.get()
+            DB_QUERY_SECONDS.labels(resolver).observe(elapsed)
+            if SLOW_QUERY_MS and elapsed * 1000 > SLOW_QUERY_MS:
+                print(f"Slow query ({elapsed * 1000:.1f} ms, {resolver}): {normalize_sql(statement)} params={redact(params)}")
+
+    async def fetchone(self):
+        row = await super().fetchone()
+        if row is not None:
+            DB_ROWS.labels(current_resolver.get()).inc()
+        return row
+
+    async def fetchmany(self, size: int = 0):
+        lst = await super().fetchmany(size)
+        DB_ROWS.labels(current_resolver.get()).inc(len(lst))
+        return lst
+
+    async def fetchall(self):
+        lst = await super().fetchall()
+        DB_ROWS.labels(current_resolver.get()).inc(len(lst))
+        return lst
+
+    async def __aiter__(self):
+        count = 0
+        try:
+            async for row in super().__aiter__():
+                count += 1
+                yield row
+        finally:
+            DB_ROWS.labels(current_resolver.get()).inc(count)
+
+class MeteredCursor(MeteredCursorMixin, psycopg.AsyncCursor):
+    pass
+
+class MeteredServerCursor(MeteredCursorMixin, psycopg.AsyncServerCursor):
+    pass
+
+async def configure_connection(conn: psycopg.AsyncConnection):
+    conn.prepared_max = PREPARED_MAX
+    if not PREPARE_STATEMENTS:
+        conn.prepare_threshold = None
+    conn.cursor_factory = MeteredCursor
+    conn.server_cursor_factory = MeteredServerCursor
+    conn.last_used = time.monotonic()
+
+async def reset_connection(conn: psycopg.AsyncConnection):
+    conn.last_used = time.monotonic()
+
+def reconnect_failed(pool: AsyncConnectionPool):
+    print("Cannot reconnect to the PostgreSQL database, the pool keeps retrying on demand")
+
+pool = AsyncConnectionPool(
+    DATABASE_URL,
+    min_size=POOL_MIN_SIZE,
+    max_size=POOL_MAX_SIZE,
+    timeout=POOL_TIMEOUT,
+    kwargs={"autocommit": True},
+    configure=configure_connection,
+    reset=reset_connection,
+    reconnect_failed=reconnect_failed,
+    open=False,
+)
+
+def backoff(attempt: int) -> float:
+    """Exponential backoff with full jitter, so that workers which lost the
+    database together do not reconnect in lockstep."""
+    return random.uniform(0, min(PG_BACKOFF_MAX, PG_BACKOFF_BASE * 2 ** attempt))
+
+async def establish_connection():
+    """Connection for the migrate step. Retries with backoff until the
+    database accepts connections or PG_MIGRATE_TIMEOUT seconds have passed,
+    so a deploy that starts together with Postgres waits for it."""
+    deadline = time.monotonic() + PG_MIGRATE_TIMEOUT
+    attempt = 0
+    while True:
+        try:
+            return await psycopg.AsyncConnection.connect(DATABASE_URL, autocommit=True)
+
+        except psycopg.OperationalError as e:
+            print(f"Connection attempt {attempt + 1} failed: {str(e)}")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise psycopg.OperationalError(f"Failed to establish a connection to the PostgreSQL database within {PG_MIGRATE_TIMEOUT:g} s")
+            await asyncio.sleep(min(backoff(attempt), remaining))
+            attempt += 1
+
+async def is_alive(conn: psycopg.AsyncConnection) -> bool:
+    if time.monotonic() - conn.last_used < PG_PREPING_IDLE:
+        return True
+    try:
+        await conn.execute("SELECT 1")
+    except psycopg.OperationalError as e:
+        print(f"Discarding dead connection: {str(e)}")
+        return False
+    return True
+
+@asynccontextmanager
+async def checkout():
+    """Pooled connection that is known to be alive. A connection that sat
+    idle for longer than PG_PREPING_IDLE is pinged first; a dead one goes back
+    to the pool, which drops it and reconnects in the background, and the
+    checkout is retried with backoff."""
+    for attempt in range(PG_CONNECT_ATTEMPTS):
+        start = time.perf_counter()
+        async with pool.connection() as conn:
+            DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - start)
+            if await is_alive(conn):
+                yield conn
+                return
+        await asyncio.sleep(backoff(attempt))
+    raise psycopg.OperationalError("No live connection to the PostgreSQL database")
+
+async def check_pool():
+    """Ping the idle connections every PG_HEALTH_CHECK_INTERVAL seconds so
+    that the ones broken by a database restart are replaced before a request
+    picks them up."""
+    while True:
+        await asyncio.sleep(PG_HEALTH_CHECK_INTERVAL)
+        await pool.check()
+
+class LoopWatchdog:
+    """Reports event-loop stalls longer than ``threshold`` seconds. A task on
+    the loop stamps a heartbeat; a daemon thread that finds the heartbeat too
+    old prints the stack the loop thread is running at that moment, which is
+    the stack of the blocking resolver."""
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self._stopped = threading.Event()
+
+    async def _beat(self):
+        while True:
+            self.heartbeat = time.monotonic()
+            await asyncio.sleep(self.threshold / 2)
+
+    def _watch(self):
+        reported = None
+        while not self._stopped.wait(self.threshold / 2):
+            heartbeat = self.heartbeat
+            stalled = time.monotonic() - heartbeat
+            if stalled > self.threshold and heartbeat != reported:
+                reported = heartbeat
+                frame = sys._current_frames().get(self._thread_id)
+                stack = "".join(traceback.format_stack(frame)) if frame else ""
+                print(f"Event loop blocked for over {stalled * 1000:.0f} ms in:\n{stack}")
+
+    def start(self):
+        self._thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self._task = asyncio.create_task(self._beat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        self._task.cancel()
+
+async def ping_database() -> dict:
+    start = time.perf_counter()
+    try:
+        async with pool.connection(timeout=HEALTH_CHECK_TIMEOUT) as conn:
+            await conn.execute("SELECT 1")
+    except psycopg.OperationalError as e:
+        return {"status": "down", "error": str(e)}
+    return {"status": "up", "latency_ms": round((time.perf_counter() - start) * 1000, 3)}
+
+async def pending_migrations(conn: psycopg.AsyncConnection) -> list:
+    try:
+        cursor = await conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    except psycopg.errors.UndefinedTable:
+        return MIGRATIONS
+    current = (await cursor.fetchone())[0]
+    return [migration for migration in MIGRATIONS if migration[0] > current]
+
+async def main():
+    """Deploy step, run as ``python3 baseapi.py migrate``: apply every pending
+    entry of MIGRATIONS in a single transaction and record the versions in
+    schema_version. When the schema is current this is one SELECT."""
+    conn = await establish_connection()
+    async with conn:
+        if not await pending_migrations(conn):
+            print("Database schema is up to date")
+            return
+        async with conn.transaction():
+            await conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INT PRIMARY KEY, applied_at TIMESTAMPTZ NOT NULL DEFAULT now())")
+            # concurrent deploys queue here and then see each other's versions
+            await conn.execute("LOCK TABLE schema_version IN EXCLUSIVE MODE")
+            pending = await pending_migrations(conn)
+            for version, statements in pending:
+                for statement in statements:
+                    await conn.execute(statement)
+                await conn.execute("INSERT INTO schema_version (version) VALUES (%s)", (version,))
+    print(f"Applied migrations {[version for version, _ in pending]}")
+
+def operation_label(execution_context) -> str:
+    """Metric label of an operation: its type and root field, e.g.
+    ``query allEmployee``. The operation name is chosen by the client, so it
+    is not used; operations selecting several root fields, or fields the
+    schema does not have, share a label per type, which keeps the number of
+    label values bounded by the schema."""
+    document = execution_context.graphql_document
+    operation = get_operation_ast(document, execution_context.operation_name) if document else None
+    if operation is None:
+        return "invalid"
+    kind = operation.operation.value
+    selections = operation.selection_set.selections
+    if len(selections) != 1:
+        return f"{kind} multiple"
+    root = execution_context.schema._schema.get_root_type(operation.operation)
+    selection = selections[0]
+    if not isinstance(selection, FieldNode) or root is None or selection.name.value not in root.fields:
+        return f"{kind} other"
+    return f"{kind} {selection.name.value}"
+
+class PrometheusMetrics(SchemaExtension):
+    """Latency and error metrics per operation and per resolver. Fields
+    served by the default attribute resolver are not timed."""
+
+    def on_operation(self):
+        start = time.perf_counter()
+        yield
+        operation = operation_label(self.execution_context)
+        OPERATION_SECONDS.labels(operation).observe(time.perf_counter() - start)
+        result = self.execution_context.result
+        if result is not None and result.errors:
+            OPERATION_ERRORS.labels(operation).inc()
+
+    def resolve(self, _next, root, info, *args, **kwargs):
+        if should_skip_tracing(_next, info):
+            return _next(root, info, *args, **kwargs)
+        return self.timed(f"{info.parent_type.name}.{info.field_name}", _next, root, info, *args, **kwargs)
+
+    async def timed(self, resolver: str, _next, root, info, *args, **kwargs):
+        token = current_resolver.set(resolver)
+        start = time.perf_counter()
+        try:
+            result = _next(root, info, *args, **kwargs)
+            if inspect.isawaitable(result):
+                result = await result
+            return result
+        except Exception:
+            RESOLVER_ERRORS.labels(resolver).inc()
+            raise
+        finally:
+            RESOLVER_SECONDS.labels(resolver).observe(time.perf_counter() - start)
+            current_resolver.reset(token)
+
+class Tracing(SchemaExtension):
+    """OpenTelemetry span tree per request: the operation, its parsing and
+    validation, and every resolver nested under the span of its parent field.
+    SQL statements become children of the resolver that ran them."""
+
+    def on_operation(self):
+        self.spans = {}
+        with tracer.start_as_current_span("GraphQL operation", kind=SpanKind.SERVER) as span:
+            self.operation = span
+            yield
+            if self.execution_context.operation_name:
+                span.update_name(f"GraphQL {self.execution_context.operation_name}")
+            result = self.execution_context.result
+            if result is not None and result.errors:
+                span.set_status(Status(StatusCode.ERROR, result.errors[0].message))
+
+    def on_parse(self):
+        with tracer.start_as_current_span("GraphQL parse"):
+            yield
+
+    def on_validate(self):
+        with tracer.start_as_current_span("GraphQL validate"):
+            yield
+
+    def resolve(self, _next, root, info, *args, **kwargs):
+        if should_skip_tracing(_next, info):
+            return _next(root, info, *args, **kwargs)
+        return self.traced(_next, root, info, *args, **kwargs)
+
+    async def traced(self, _next, root, info, *args, **kwargs):
+        parent = info.path.prev
+        while parent is not None and parent not in self.spans:
+            parent = parent.prev
+        context = trace.set_span_in_context(self.spans[parent] if parent is not None else self.operation)
+        with tracer.start_as_current_span(
+            f"{info.parent_type.name}.{info.field_name}",
+            context=context,
+            attributes={"graphql.path": ".".join(map(str, info.path.as_list()))},
+        ) as span:
+            self.spans[info.path] = span
+            result = _next(root, info, *args, **kwargs)
+            if inspect.isawaitable(result):
+                result = await result
+            return result
+
+class QueryCostRule(ValidationRule):
+    """Rejects an operation whose estimated cost is over MAX_QUERY_COST
+    before any resolver runs. Every object field costs 1 plus the cost of its
+    selection, times the rows it can return: its first argument (capped at
+    MAX_PAGE_SIZE, like paginate) or limit argument, falling back to the
+    argument's default. A field whose limit is left out or null is unbounded
+    and counts as MAX_LIST_SIZE rows. Validation runs before variables are
+    bound, so an argument passed as a variable counts at those same
+    ceilings. A negative first or limit, or a limit over MAX_LIST_SIZE, is
+    rejected here, so no other field of the operation runs first.
+
+    A relationship list has no argument and is not limited either; it
+    counts as QUERY_LIST_SIZE rows, so for those the cost is an estimate
+    rather than an upper bound."""
+
+    def enter_operation_definition(self, node, *_):
+        cost = self.selection_cost(self.context.schema.get_root_type(node.operation), node.selection_set, frozenset())
+        if cost > MAX_QUERY_COST:
+            self.report_error(GraphQLError(f"Query cost {cost} exceeds the limit of {MAX_QUERY_COST}", node))
+
+    def rows(self, node: FieldNode, field, is_list: bool) -> int:
+        arguments = {argument.name.value: argument for argument in node.arguments}
+        for name, ceiling in (("first", MAX_PAGE_SIZE), ("limit", MAX_LIST_SIZE)):
+            if name not in field.args:
+                continue
+            argument = arguments.get(name)
+            if argument is None:
+                value = field.args[name].default_value
+            elif isinstance(argument.value, IntValueNode):
+                value = int(argument.value.value)
+            else:
+                # a variable or null
+                return ceiling
+            if not isinstance(value, int):
+                return ceiling
+            if value < 0:
+                self.report_error(GraphQLError(f"{name} must not be negative", argument or node))
+                return 0
+            if name == "limit" and value > MAX_LIST_SIZE:
+                self.report_error(GraphQLError(f"limit must not exceed {MAX_LIST_SIZE}", argument or node))
+            return min(value, ceiling)
+        # the edges of a connection are already counted by its first
+        return QUERY_LIST_SIZE if is_list and node.name.value != "edges" else 1
+
+    def selection_cost(self, parent, selection_set, fragments: frozenset) -> int:
+        cost = 0
+        for selection in selection_set.selections:
+            if isinstance(selection, FieldNode):
+                field = getattr(parent, "fields", {}).get(selection.name.value)
+                # scalars cost nothing; unknown fields are another rule's error
+                if field is None or selection.selection_set is None:
+                    continue
+                field_type = get_nullable_type(field.type)
+                rows = self.rows(selection, field, is_list_type(field_type))
+                cost += rows * (1 + self.selection_cost(get_named_type(field_type), selection.selection_set, fragments))
+            elif isinstance(selection, InlineFragmentNode):
+                condition = selection.type_condition
+                cost += self.selection_cost(self.context.schema.get_type(condition.name.value) if condition else parent, selection.selection_set, fragments)
+            elif isinstance(selection, FragmentSpreadNode):
+                fragment = self.context.get_fragment(selection.name.value)
+                if fragment is None or selection.name.value in fragments:
+                    continue
+                cost += self.selection_cost(self.context.schema.get_type(fragment.type_condition.name.value), fragment.selection_set, fragments | {selection.name.value})
+        return cost
+
+class ChangeFeed:
+    """Row changes announced by the notify_change() trigger on the
+    ``changes`` channel. One LISTEN connection per worker receives them. It
+    evicts the changed row from entity_cache and hands the change to every
+    subscriber of that table. The connection is re-established with backoff
+    when it drops."""
+
+    def __init__(self):
+        self.subscribers = collections.defaultdict(set)
+
+    def start(self):
+        self._task = asyncio.create_task(self._listen())
+
+    def stop(self):
+        self._task.cancel()
+
+    async def _listen(self):
+        attempt = 0
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(DATABASE_URL, autocommit=True) as conn:
+                    await conn.execute("LISTEN changes")
+                    attempt = 0
+                    async for notify in conn.notifies():
+                        self.publish(json.loads(notify.payload))
+            except psycopg.OperationalError as e:
+                print(f"Change feed disconnected: {str(e)}")
+                await asyncio.sleep(backoff(attempt))
+                attempt += 1
+
+    def publish(self, change: dict):
+        cls = TABLES.get(change["table"])
+        if cls is None:
+            return
+        entity_cache.invalidate(cls.__name__, change["id"])
+        for queue in list(self.subscribers[cls]):
+            if queue.qsize() >= SUBSCRIPTION_QUEUE_SIZE:
+                # the queue has one spare slot for the disconnect marker
+                self.subscribers[cls].discard(queue)
+                queue.put_nowait(None)
+            else:
+                queue.put_nowait(change)
+
+    async def subscribe(self, cls) -> typing.AsyncIterator[dict]:
+        queue = asyncio.Queue(SUBSCRIPTION_QUEUE_SIZE + 1)
+        self.subscribers[cls].add(queue)
+        try:
+            while (change := await queue.get()) is not None:
+                yield change
+            raise RuntimeError("Subscription dropped because the client fell behind")
+        finally:
+            self.subscribers[cls].discard(queue)
+
+change_feed = ChangeFeed()
+
+class Context(BaseContext):
+    """Per-request context. A pooled connection is checked out on first use
+    and handed back to the pool once the response has been sent."""
+
+    def __init__(self):
+        super().__init__()
+        self._conn = None
+        self._checkout = None
+        self._lock = asyncio.Lock()
+        self._loaders = {}
+
+    async def connection(self) -> psycopg.AsyncConnection:
+        async with self._lock:
+            if self._conn is None:
+                self._checkout = checkout()
+                self._conn = await self._checkout.__aenter__()
+        return self._conn
+
+    def loader(self, cls, column: str, many: bool = False) -> DataLoader:
+        """DataLoader for the ``cls`` rows whose ``column`` equals each key.
+        Every key requested during one tick is fetched by a single
+        ``WHERE column = ANY(%s)`` query. With ``many`` each key resolves to a
+        list of ``cls``, otherwise to one ``cls`` or None."""
+        key = (cls, column, many)
+        if key not in self._loaders:
+            self._loaders[key] = DataLoader(
+                load_fn=functools.partial(self._load_rows, cls, column, many),
+                cache_key_fn=str,
+            )
+        return self._loaders[key]
+
+    async def _load_rows(self, cls, column, many, keys):
+        conn = await self.connection()
+        cursor = conn.cursor(row_factory=dict_row)
+        await cursor.execute(f"SELECT {', '.join(columns_of(cls))} FROM {cls.__name__} WHERE {column} = ANY(%s)", (list(keys),))
+        grouped = {}
+        for row in await cursor.fetchall():
+            grouped.setdefault(str(row[column]), []).append(from_row(cls, row))
+        if many:
+            return [grouped.get(str(key), []) for key in keys]
+        return [grouped.get(str(key), [None])[0] for key in keys]
+
+    async def release(self):
+        if self._checkout is not None:
+            await self._checkout.__aexit__(None, None, None)
+            self._conn = None
+            self._checkout = None
+
+class EntityCache:
+    """Bounded LRU of rows keyed by (table, id), each entry expiring after
+    ``ttl`` seconds. The cache is per process: update_*/delete_* invalidate
+    the entries of the worker that ran them and the TTL bounds how stale
+    any other worker can be. A ``maxsize`` of 0 disables it."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._rows = collections.OrderedDict()
+
+    def get(self, table: str, id) -> typing.Optional[dict]:
+        key = (table, str(id))
+        entry = self._rows.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            self._rows.pop(key, None)
+            self.misses += 1
+            return None
+        self._rows.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, table: str, id, row: dict):
+        if not self.maxsize:
+            return
+        key = (table, str(id))
+        self._rows[key] = (row, time.monotonic() + self.ttl)
+        self._rows.move_to_end(key)
+        while len(self._rows) > self.maxsize:
+            self._rows.popitem(last=False)
+
+    def invalidate(self, table: str, id):
+        self._rows.pop((table, str(id)), None)
+
+    def stats(self) -> dict:
+        return {"size": len(self._rows), "maxsize": self.maxsize, "ttl": self.ttl, "hits": self.hits, "misses": self.misses}
+
+entity_cache = EntityCache(ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL)
+
+class DocumentCache(ParserCache):
+    """ParserCache that leaves a query with a syntax error to the executor,
+    which answers it with a GraphQL error instead of letting it escape as a
+    server error."""
+
+    def on_parse(self):
+        try:
+            self.execution_context.graphql_document = self.cached_parse_document(self.execution_context.query)
+        except GraphQLError:
+            pass
+        yield
+
+class PersistedQueryNotFound(Exception):
+    pass
+
+class PersistedQueryRouter(GraphQLRouter):
+    """GraphQLRouter speaking the automatic persisted queries protocol.
+    A request carrying ``extensions.persistedQuery.sha256Hash`` and no query
+    is served from a bounded LRU of query texts; on a miss the client gets
+    PERSISTED_QUERY_NOT_FOUND and retries once with the full query, which is
+    then stored under its hash. Parsing and validation of repeat documents
+    are skipped by the DocumentCache/ValidationCache schema extensions."""
+
+    def __init__(self, *args, cache_size: int = PERSISTED_QUERY_CACHE_SIZE, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_size = cache_size
+        self.queries = collections.OrderedDict()
+
+    def should_render_graphiql(self, request) -> bool:
+        return request.query_params.get("extensions") is None and super().should_render_graphiql(request)
+
+    async def parse_http_body(self, request) -> GraphQLRequestData:
+        if "application/json" in (request.content_type or ""):
+            body = self.parse_json(await request.get_body())
+            if not isinstance(body, dict):
+                raise HTTPException(status_code=400, detail="request body must be a JSON object")
+            request_data = await super().parse_http_body(request)
+            extensions = body.get("extensions")
+        else:
+            request_data = await super().parse_http_body(request)
+            extensions = request.query_params.get("extensions")
+        if isinstance(extensions, str):
+            try:
+                extensions = json.loads(extensions)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="extensions must be a JSON object") from None
+        if extensions is None:
+            return request_data
+        if not isinstance(extensions, dict):
+            raise HTTPException(status_code=400, detail="extensions must be a JSON object")
+        persisted = extensions.get("persistedQuery")
+        if not persisted:
+            return request_data
+        if not isinstance(persisted, dict) or not isinstance(persisted.get("sha256Hash"), str):
+            raise HTTPException(status_code=400, detail="persistedQuery must be an object with a sha256Hash string")
+
+        sha256 = persisted["sha256Hash"]
+        if request_data.query is None:
+            request_data.query = self.queries.get(sha256)
+            if request_data.query is None:
+                raise PersistedQueryNotFound()
+            self.queries.move_to_end(sha256)
+        else:
+            if hashlib.sha256(request_data.query.encode()).hexdigest() != sha256:
+                raise HTTPException(status_code=400, detail="provided sha does not match query")
+            self.queries[sha256] = request_data.query
+            while len(self.queries) > self.cache_size:
+                self.queries.popitem(last=False)
+        return request_data
+
+    async def execute_operation(self, request, context, root_value) -> ExecutionResult:
+        try:
+            return await super().execute_operation(request, context, root_value)
+        except PersistedQueryNotFound:
+            return ExecutionResult(
+                data=None,
+                errors=[GraphQLError("PersistedQueryNotFound", extensions={"code": "PERSISTED_QUERY_NOT_FOUND"})],
+            )
+
+async def get_context():
+    context = Context()
+    try:
+        yield context
+    finally:
+        await context.release()
+
+T = typing.TypeVar("T")
+
+@strawberry.type
+class PageInfo:
+    has_next_page: bool
+    end_cursor: typing.Optional[str]
+
+@strawberry.type
+class Edge(typing.Generic[T]):
+    node: T
+    cursor: str
+
+@strawberry.type
+class Connection(typing.Generic[T]):
+    edges: typing.List[Edge[T]]
+    page_info: PageInfo
+
+@strawberry.input
+class NumberFilter:
+    eq: typing.Optional[str] = None
+    in_: typing.Optional[typing.List[str]] = strawberry.field(default=None, name="in")
+    gt: typing.Optional[str] = None
+    gte: typing.Optional[str] = None
+    lt: typing.Optional[str] = None
+    lte: typing.Optional[str] = None
+
+@strawberry.input
+class TextFilter(NumberFilter):
+    prefix: typing.Optional[str] = None
+
+FILTER_OPERATORS = {"eq": "=", "gt": ">", "gte": ">=", "lt": "<", "lte": "<="}
+
+def compile_where(where, predicates: typing.Sequence[str] = (), params: typing.Sequence = ()) -> typing.Tuple[str, list]:
+    """`` WHERE ...`` clause (or "") and its parameters for an <Entity>Where
+    input, ANDed with ``predicates``. Every operator compiles to a
+    parameterized comparison on the bare column so that an index on it can
+    serve the predicate; ``prefix`` becomes ``LIKE 'abc%'``, which a
+    text_pattern_ops index serves."""
+    predicates, params = list(predicates), list(params)
+    for field in dataclasses.fields(where) if where is not None else ():
+        condition = getattr(where, field.name)
+        if condition is None:
+            continue
+        for operator in dataclasses.fields(condition):
+            value = getattr(condition, operator.name)
+            if value is None:
+                continue
+            if operator.name == "in_":
+                predicates.append(f"{field.name} IN ({', '.join(['%s'] * len(value))})" if value else "FALSE")
+                params.extend(value)
+            elif operator.name == "prefix":
+                predicates.append(f"{field.name} LIKE %s")
+                params.append(re.sub(r"([\\%_])", r"\\\1", value) + "%")
+            else:
+                predicates.append(f"{field.name} {FILTER_OPERATORS[operator.name]} %s")
+                params.append(value)
+    return (" WHERE " + " AND ".join(predicates) if predicates else ""), params
+
+@strawberry.enum
+class SortDirection(enum.Enum):
+    ASC = "ASC"
+    DESC = "DESC"
+
+def compile_order(order_by, limit: typing.Optional[int]) -> typing.Tuple[str, list]:
+    """`` ORDER BY ... LIMIT %s`` for a list of <Entity>Order inputs and its
+    parameters. Only the columns listed in <Entity>SortColumn can be
+    ordered by and each of them has an index, so ``ORDER BY ... LIMIT n``
+    reads the first n index entries instead of sorting the table. A limit
+    over MAX_LIST_SIZE is an error rather than a silently shorter list."""
+    clause = ""
+    if order_by:
+        clause = " ORDER BY " + ", ".join(f"{order.column.value} {order.direction.value}" for order in order_by)
+    if limit is None:
+        return clause, []
+    if limit < 0:
+        raise ValueError("limit must not be negative")
+    if limit > MAX_LIST_SIZE:
+        raise ValueError(f"limit must not exceed {MAX_LIST_SIZE}")
+    return clause + " LIMIT %s", [limit]
+
+def columns_of(cls) -> typing.List[str]:
+    return [f.name for f in dataclasses.fields(cls) if f.init]
+
+def from_row(cls, row: dict):
+    """Build ``cls`` from a possibly partial row; columns that were not
+    selected are left as None and are never resolved. Columns ``cls`` does
+    not declare, such as ones a newer migration added, are dropped."""
+    values = dict.fromkeys(columns_of(cls))
+    values.update((column, value) for column, value in row.items() if column in values)
+    return cls(**values)
+
+def _flatten(selections):
+    for selection in selections:
+        if isinstance(selection, SelectedField):
+            yield selection
+        else:
+            yield from _flatten(selection.selections)
+
+def selected_columns(info: Info, cls, path: typing.Sequence[str] = ()) -> typing.List[str]:
+    """Columns of ``cls`` requested by the current selection set, plus ``id``
+    and any column a selected relationship field needs (RELATIONSHIP_COLUMNS).
+    ``path`` descends into nested selections, e.g. ``("edges", "node")``."""
+    selections = info.selected_fields[0].selections
+    for name in path:
+        selections = [s for sel in _flatten(selections) if sel.name == name for s in sel.selections]
+    name_converter = info.schema.config.name_converter
+    python_names = {name_converter.get_graphql_name(f): f.python_name for f in cls._type_definition.fields}
+    related = RELATIONSHIP_COLUMNS.get(cls.__name__, {})
+    wanted = {"id"}
+    for selection in _flatten(selections):
+        python_name = python_names.get(selection.name)
+        wanted.add(python_name)
+        wanted.update(related.get(python_name, []))
+    return [column for column in columns_of(cls) if column in wanted]
+
+async def get_row(info: Info, cls, id) -> typing.Optional[dict]:
+    """Row of ``cls`` with primary key ``id``. With the entity cache enabled
+    the whole row is fetched and cached; otherwise only the selected columns
+    are read."""
+    table = cls.__name__
+    if entity_cache.maxsize:
+        row = entity_cache.get(table, id)
+        if row is not None:
+            return row
+        columns = columns_of(cls)
+    else:
+        columns = selected_columns(info, cls)
+    conn = await info.context.connection()
+    cursor = conn.cursor(row_factory=dict_row)
+    await cursor.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE id = %s", (id,), prepare=PREPARE_STATEMENTS)
+    row = await cursor.fetchone()
+    if row is not None and entity_cache.maxsize:
+        entity_cache.set(table, id, row)
+    return row
+
+async def bulk_insert(info: Info, cls, items: list) -> typing.List[str]:
+    """Insert ``items`` (input objects with the columns of ``cls``) with a few
+    multi-row INSERTs inside one transaction and return the new ids in input
+    order. SERIAL ids are drawn in VALUES order, so sorting each statement's
+    RETURNING ids restores that order."""
+    columns = [column for column in columns_of(cls) if column != "id"]
+    # Postgres accepts at most 65535 bind parameters per statement
+    chunk_size = max(1, min(BULK_INSERT_CHUNK_SIZE, 65535 // len(columns)))
+    placeholders = f"({', '.join(['%s'] * len(columns))})"
+    conn = await info.context.connection()
+    ids = []
+    async with conn.transaction():
+        for start in range(0, len(items), chunk_size):
+            chunk = items[start:start + chunk_size]
+            cursor = await conn.execute(
+                f"INSERT INTO {cls.__name__} ({', '.join(columns)}) VALUES {', '.join([placeholders] * len(chunk))} RETURNING id",
+                [getattr(item, column) for item in chunk for column in columns],
+                prepare=PREPARE_STATEMENTS,
+            )
+            ids.extend(sorted(row[0] for row in await cursor.fetchall()))
+    return ids
+
+async def prewarm_cache(tables: typing.List[str]):
+    async with checkout() as conn:
+        for table in tables:
+            cls = TABLES[table]
+            cursor = conn.cursor(row_factory=dict_row)
+            await cursor.execute(f"SELECT {', '.join(columns_of(cls))} FROM {cls.__name__} ORDER BY id LIMIT %s", (entity_cache.maxsize,))
+            for row in await cursor.fetchall():
+                entity_cache.set(cls.__name__, row["id"], row)
+            print(f"Pre-warmed entity cache with {cursor.rowcount} rows from {cls.__name__}")
+
+# Widths of the Postgres integer type oids; column_parser() handles these,
+# real, double and numeric, and passes every other column through as text.
+INTEGER_BITS = {
+    20: 64,
+    21: 16,
+    23: 32,
+}
+FLOAT4_MAX = 3.4028234663852886e38
+# numeric limits of Postgres: digits before and after the decimal point
+NUMERIC_MAX_WEIGHT = 131072
+NUMERIC_MAX_SCALE = 16383
+
+class ImportAborted(Exception):
+    pass
+
+def to_number(convert, value: str):
+    # int(), float() and Decimal() also take digit separators and non-ASCII digits
+    if "_" in value or not value.isascii():
+        raise ValueError("not a number")
+    try:
+        return convert(value)
+    except (ValueError, ArithmeticError):
+        raise ValueError("not a number") from None
+
+def column_parser(column: psycopg.Column) -> typing.Callable[[str], typing.Any]:
+    """Parse a text value and check it against what Postgres accepts for
+    ``column``: integer ranges, numeric precision and ``varchar(n)`` lengths
+    from the column's typmod. A value COPY would reject then fails its own
+    row instead of the whole import."""
+    oid = column.type_code
+    if oid in INTEGER_BITS:
+        bound = 2 ** (INTEGER_BITS[oid] - 1)
+
+        def parse(value: str) -> int:
+            number = to_number(int, value)
+            if not -bound <= number < bound:
+                raise ValueError("integer out of range")
+            return number
+    elif oid in (700, 701):
+        def parse(value: str) -> float:
+            number = to_number(float, value)
+            if oid == 700 and math.isfinite(number) and abs(number) > FLOAT4_MAX:
+                raise ValueError("real out of range")
+            return number
+    elif oid == 1700:
+        def parse(value: str) -> decimal.Decimal:
+            number = to_number(decimal.Decimal, value)
+            if not number.is_finite():
+                # numeric takes Infinity only from PostgreSQL 14 on
+                if number.is_nan():
+                    return number
+                raise ValueError("numeric out of range")
+            try:
+                if column.precision is not None:
+                    scale = column.scale or 0
+                    fits = abs(round(number, scale)) < 10 ** (column.precision - scale)
+                else:
+                    fits = not number or (number.adjusted() < NUMERIC_MAX_WEIGHT and -number.as_tuple().exponent <= NUMERIC_MAX_SCALE)
+            except ArithmeticError:
+                fits = False
+            if not fits:
+                raise ValueError("numeric out of range")
+            return number
+    else:
+        def parse(value: str) -> str:
+            if "\x00" in value:
+                raise ValueError("contains a NUL character")
+            try:
+                value.encode()
+            except UnicodeEncodeError:
+                # a lone surrogate from a JSON escape
+                raise ValueError("not valid Unicode") from None
+            if column.display_size is not None and len(value) > column.display_size:
+                raise ValueError(f"longer than {column.display_size} characters")
+            return value
+    return parse
+
+async def column_parsers(conn: psycopg.AsyncConnection, table: str) -> dict:
+    cursor = await conn.execute(f"SELECT * FROM {table} LIMIT 0")
+    return {column.name: column_parser(column) for column in cursor.description}
+
+async def request_lines(request: Request) -> typing.AsyncIterator[typing.Optional[bytes]]:
+    """Split the request body into lines as it arrives, without buffering
+    more than one chunk. Lines keep their ``\\n`` and are not decoded yet,
+    so bad UTF-8 only fails the record it is in. A line longer than
+    IMPORT_MAX_RECORD_BYTES is dropped as it arrives and yielded as None."""
+    buffer = b""
+    oversized = False
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for count, line in enumerate(lines, 1):
+            if count % 1000 == 0:
+                # lines inside an open quote yield no record to insert; let other requests run
+                await asyncio.sleep(0)
+            if oversized:
+                # the end of the dropped line
+                oversized = False
+                continue
+            yield line + b"\n"
+        if len(buffer) > IMPORT_MAX_RECORD_BYTES:
+            if not oversized:
+                oversized = True
+                yield None
+            buffer = b""
+    if buffer and not oversized:
+        yield buffer
+
+class LineFeed:
+    """Input of a csv.reader that is refilled between records, so a single
+    reader parses the whole body. Running dry raises StopIteration, which
+    does not exhaust the reader."""
+
+    def __init__(self):
+        self.lines = collections.deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        if not self.lines:
+            raise StopIteration
+        return self.lines.popleft()
+
+QUOTE_OR_DELIMITER = re.compile(r'[",]')
+
+def quoted_after(line: str, quoted: bool) -> bool:
+    """Whether a quoted CSV field is still open at the end of ``line``,
+    given whether one was open at its start. Follows csv.reader: a quote
+    opens a field only as its first character, and ``""`` inside a quoted
+    field is a literal quote."""
+    if '"' not in line:
+        return quoted
+    field_start = None if quoted else 0
+    escaped = False
+    for match in QUOTE_OR_DELIMITER.finditer(line):
+        position = match.start()
+        if escaped:
+            escaped = False
+        elif quoted:
+            if match.group() == '"':
+                if line.startswith('"', position + 1):
+                    escaped = True
+                else:
+                    quoted = False
+        elif match.group() == ",":
+            field_start = position + 1
+        elif position == field_start:
+            quoted = True
+    return quoted
+
+async def body_records(lines: typing.AsyncIterator[typing.Optional[bytes]], ndjson: bool) -> typing.AsyncIterator[typing.Tuple[int, typing.Any]]:
+    """``(line number, record)`` for every non-blank record of the body: the
+    decoded line for NDJSON, the list of fields for CSV. A quoted CSV field
+    may contain newlines: lines are collected until the record's quotes are
+    closed and then read by one csv.reader, so every line is scanned once.
+    The record is numbered by its first line. A record that is not valid
+    UTF-8, not valid CSV or longer than IMPORT_MAX_RECORD_BYTES comes back
+    as its ValueError; after an over-long one parsing resumes at the next
+    line."""
+    feed = LineFeed()
+    reader = csv.reader(feed)
+    line_no = 0
+    start = 0
+    size = 0
+    quoted = False
+    error = None
+    async for raw in lines:
+        line_no += 1
+        if raw is None or size + len(raw) > IMPORT_MAX_RECORD_BYTES:
+            yield (start if feed.lines else line_no), ValueError(f"record longer than {IMPORT_MAX_RECORD_BYTES} bytes")
+            feed.lines.clear()
+            size = 0
+            quoted = False
+            error = None
+            continue
+        try:
+            line = raw.decode()
+        except UnicodeDecodeError as e:
+            # keep the bytes readable for the quote scan and fail the record once it ends
+            line = raw.decode(errors="surrogateescape")
+            error = error or ValueError(f"invalid UTF-8 at byte {e.start} of line {line_no}")
+        if not feed.lines and not line.strip():
+            continue
+        if ndjson:
+            yield line_no, error or line
+            error = None
+            continue
+        if not feed.lines:
+            start = line_no
+        feed.lines.append(line)
+        size += len(raw)
+        quoted = quoted_after(line, quoted)
+        if quoted:
+            continue
+        try:
+            record = next(reader)
+        except csv.Error as e:
+            record = ValueError(str(e))
+        feed.lines.clear()
+        yield start, error or record
+        size = 0
+        error = None
+    if feed.lines:
+        yield start, ValueError("unterminated quoted field")
+
+def parse_record(record, columns: typing.List[str], parsers: dict, ndjson: bool) -> list:
+    if isinstance(record, ValueError):
+        raise record
+    if ndjson:
+        record = json.loads(record)
+        if not isinstance(record, dict):
+            raise ValueError("expected a JSON object")
+        unknown = set(record) - set(columns)
+        if unknown:
+            raise ValueError(f"unknown columns {sorted(unknown)}")
+        values = [record.get(column) for column in columns]
+    else:
+        if len(record) != len(columns):
+            raise ValueError(f"expected {len(columns)} fields, got {len(record)}")
+        values = [None if value == "" else value for value in record]
+    parsed = []
+    for column, value in zip(columns, values):
+        try:
+            parsed.append(None if value is None else parsers[column](str(value)))
+        except (ValueError, ArithmeticError) as e:
+            raise ValueError(f"invalid value {value!r} for column {column}: {e}")
+    return parsed
+
+async def copy_import(cls, lines: typing.AsyncIterator[typing.Optional[bytes]], ndjson: bool, max_errors: int) -> dict:
+    """Validate CSV (header line first) or NDJSON records against the
+    columns of ``cls`` and stream the valid ones into ``COPY ... FROM STDIN``.
+    Invalid records are skipped and reported by line number; more than
+    ``max_errors`` of them aborts and rolls back the whole import."""
+    table = cls.__name__
+    allowed = [column for column in columns_of(cls) if column != "id"]
+    start = time.perf_counter()
+    rows = 0
+    errors = []
+    records = body_records(lines, ndjson)
+    async with checkout() as conn:
+        parsers = await column_parsers(conn, table)
+        if ndjson:
+            columns = allowed
+        else:
+            header = (await anext(records, (0, [])))[1]
+            columns = [] if isinstance(header, ValueError) else [column.strip().lower() for column in header]
+            unknown = set(columns) - set(allowed)
+            if unknown or not columns:
+                raise HTTPException(status_code=400, detail=f"CSV header must name columns of {table} from {allowed}")
+        cursor = conn.cursor()
+        try:
+            async with cursor.copy(f"COPY {table} ({', '.join(columns)}) FROM STDIN") as copy:
+                async for line_no, record in records:
+                    try:
+                        values = parse_record(record, columns, parsers, ndjson)
+                    except ValueError as e:
+                        errors.append({"line": line_no, "error": str(e)})
+                        if len(errors) > max_errors:
+                            raise ImportAborted()
+                        continue
+                    await copy.write_row(values)
+                    rows += 1
+        except psycopg.errors.QueryCanceled as e:
+            # psycopg cancels the COPY and raises QueryCanceled when the block fails
+            if len(errors) > max_errors:
+                raise ImportAborted() from e
+            raise
+    seconds = time.perf_counter() - start
+    return {
+        "table": table,
+        "rows": rows,
+        "seconds": round(seconds, 3),
+        "rows_per_second": round(rows / seconds) if seconds else rows,
+        "errors": errors,
+    }
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "COPY (SELECT {columns} FROM {table}) TO STDOUT WITH (FORMAT csv, HEADER)"),
+    # row_to_json never emits raw newlines and escapes control characters, so
+    # CSV with control-character quote/delimiter passes each object through
+    # untouched (text format would double every backslash).
+    "ndjson": ("application/x-ndjson", "COPY (SELECT row_to_json(r)::text FROM (SELECT {columns} FROM {table}) r) TO STDOUT WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')"),
+}
+
+async def copy_export(cls, format: str) -> typing.AsyncIterator[bytes]:
+    """Stream a whole table out of ``COPY ... TO STDOUT`` in chunks of about
+    EXPORT_CHUNK_BYTES, so memory stays flat whatever the table size."""
+    statement = EXPORT_FORMATS[format][1].format(columns=", ".join(columns_of(cls)), table=cls.__name__)
+    async with checkout() as conn:
+        cursor = conn.cursor()
+        async with cursor.copy(statement) as copy:
+            buffer = bytearray()
+            async for data in copy:
+                buffer += data
+                if len(buffer) >= EXPORT_CHUNK_BYTES:
+                    yield bytes(buffer)
+                    buffer.clear()
+            if buffer:
+                yield bytes(buffer)
+
+# Arrow types for the Postgres type oids the generator emits; numeric is
+# exported as float64 and everything unlisted as string.
+ARROW_TYPES = {
+    16: pyarrow.bool_(),
+    20: pyarrow.int64(),
+    21: pyarrow.int16(),
+    23: pyarrow.int32(),
+    700: pyarrow.float32(),
+    701: pyarrow.float64(),
+    1700: pyarrow.float64(),
+}
+ARROW_FORMATS = {
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+# end-of-stream marker of the Arrow IPC streaming format
+ARROW_EOS = b"\xff\xff\xff\xff\x00\x00\x00\x00"
+
+async def arrow_schema(conn: psycopg.AsyncConnection, cls) -> pyarrow.Schema:
+    cursor = await conn.execute(f"SELECT {', '.join(columns_of(cls))} FROM {cls.__name__} LIMIT 0")
+    return pyarrow.schema([(column.name, ARROW_TYPES.get(column.type_code, pyarrow.string())) for column in cursor.description])
+
+async def arrow_batches(conn: psycopg.AsyncConnection, cls, schema: pyarrow.Schema) -> typing.AsyncIterator[pyarrow.RecordBatch]:
+    """Typed record batches of ARROW_BATCH_SIZE rows, built column by column
+    from the chunks of a named server-side cursor."""
+    # cast numeric in SQL so the driver hands back floats instead of Decimals
+    select = ", ".join(f"{f.name}::float8 AS {f.name}" if f.type == pyarrow.float64() else f.name for f in schema)
+    async with conn.transaction():
+        cursor = conn.cursor(name=f"arrow_{uuid.uuid4().hex}")
+        await cursor.execute(f"SELECT {select} FROM {cls.__name__}")
+        while True:
+            lst = await cursor.fetchmany(ARROW_BATCH_SIZE)
+            if not lst:
+                break
+            columns = zip(*lst)
+            yield pyarrow.RecordBatch.from_arrays([pyarrow.array(column, type=f.type) for column, f in zip(columns, schema)], schema=schema)
+        await cursor.close()
+
+async def arrow_export(cls) -> typing.AsyncIterator[bytes]:
+    """Arrow IPC stream: the schema message, one message per record batch,
+    then the end-of-stream marker."""
+    async with checkout() as conn:
+        schema = await arrow_schema(conn, cls)
+        yield schema.serialize().to_pybytes()
+        async for batch in arrow_batches(conn, cls, schema):
+            yield batch.serialize().to_pybytes()
+    yield ARROW_EOS
+
+async def parquet_export(cls) -> str:
+    """Write the table to a temporary Parquet file, one row group per record
+    batch, and return its path. Parquet keeps its footer at the end of the
+    file, so it is spooled to disk rather than streamed."""
+    path = tempfile.NamedTemporaryFile(suffix=".parquet", delete=False).name
+    async with checkout() as conn:
+        schema = await arrow_schema(conn, cls)
+        with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+            async for batch in arrow_batches(conn, cls, schema):
+                # compressing a batch takes long enough to stall the loop
+                await asyncio.to_thread(writer.write_batch, batch)
+    return path
+
+def encode_cursor(id) -> str:
+    return base64.b64encode(f"cursor:{id}".encode()).decode()
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        return int(base64.b64decode(cursor).decode().split(":", 1)[1])
+    except (ValueError, IndexError):
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+async def paginate(info: Info, cls, table: str, first: int, after: typing.Optional[str], where=None) -> Connection:
+    """Keyset pagination on the primary key: the page after ``after`` is read
+    with ``WHERE id > %s ORDER BY id LIMIT n`` so every page costs one index
+    range scan no matter how deep into the table it is."""
+    if first < 0:
+        raise ValueError("first must not be negative")
+    first = min(first, MAX_PAGE_SIZE)
+    columns = ", ".join(selected_columns(info, cls, ("edges", "node")))
+    conn = await info.context.connection()
+    cursor = conn.cursor(row_factory=dict_row)
+    if after is None:
+        clause, params = compile_where(where)
+    else:
+        clause, params = compile_where(where, ["id > %s"], [decode_cursor(after)])
+    await cursor.execute(f"SELECT {columns} FROM {table}{clause} ORDER BY id LIMIT %s", (*params, first + 1))
+    lst = await cursor.fetchall()
+    edges = [Edge(node=from_row(cls, i), cursor=encode_cursor(i["id"])) for i in lst[:first]]
+    return Connection(
+        edges=edges,
+        page_info=PageInfo(
+            has_next_page=len(lst) > first,
+            end_cursor=edges[-1].cursor if edges else None,
+        ),
     )
 
-    # reconnect if connection is closed
-    conn.autocommit = True
-    cursor = conn.cursor()
+async def stream_table(cls, chunk_size: int = STREAM_CHUNK_SIZE) -> typing.AsyncIterator:
+    """Yield every row of ``cls``'s table as a ``cls`` instance. Rows are read
+    from a named server-side cursor ``chunk_size`` at a time, so memory is
+    bounded by the chunk size rather than by the table."""
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1")
+    async with checkout() as conn:
+        async with conn.transaction():
+            cursor = conn.cursor(name=f"stream_{uuid.uuid4().hex}", row_factory=dict_row)
+            cursor.itersize = chunk_size
+            await cursor.execute(f"SELECT {', '.join(columns_of(cls))} FROM {cls.__name__}")
+            async for i in cursor:
+                yield cls(**i)
+            await cursor.close()
+
+def to_dict(obj) -> dict:
+    return {name: getattr(obj, name) for name in columns_of(obj)}
+
+class JsonDataSource:
+    """Records of a JSON array file, indexed by ``key``. The file is parsed
+    once and parsed again only after its mtime or size changes, so a lookup
+    costs a stat and a dict access. When several records share a key the first one
+    wins."""
+
+    def __init__(self, path: str, key: str = "id"):
+        self.path = path
+        self.key = key
+        self._lock = threading.Lock()
+        self._loaded = (None, {}, [])
+
+    def _records(self) -> tuple:
+        stat = os.stat(self.path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        if self._loaded[0] != version:
+            with self._lock:
+                if self._loaded[0] != version:
+                    with open(self.path, "rb") as f:
+                        records = json.loads(f.read())
+                    index = {}
+                    for record in records:
+                        index.setdefault(record[self.key], record)
+                    self._loaded = (version, index, records)
+        return self._loaded
 
-    print("Connected to the PostgreSQL database")
+    def get(self, key) -> typing.Optional[dict]:
+        return self._records()[1].get(key)
 
-except (Exception, psycopg2.DatabaseError) as error:
-    print("Cannot connect to the PostgreSQL database")
-    print(error)  
+    def all(self) -> list:
+        return self._records()[2]
 
 #*main
-def main():
-    cursor.execute('CREATE TABLE IF NOT EXISTS Fish (id SERIAL PRIMARY KEY, type VARCHAR(200), color VARCHAR(200))') 
-    conn.commit() 
-    cursor.execute('CREATE TABLE IF NOT EXISTS Sample (id SERIAL PRIMARY KEY, word VARCHAR(255))') 
-    conn.commit() 
-    print("Table created successfully")
+# Applied once each, in order, by `python3 baseapi.py migrate` and recorded in
+# schema_version. Applied entries are never edited: a schema change such as a
+# new column is appended as a new version (ALTER TABLE ... ADD COLUMN), so
+# existing rows are kept.
+MIGRATIONS = [
+    (1, [
+        'CREATE TABLE IF NOT EXISTS Fish (id SERIAL PRIMARY KEY, type VARCHAR(200), color VARCHAR(200))',
+        'CREATE TABLE IF NOT EXISTS Sample (id SERIAL PRIMARY KEY, word VARCHAR(255))',
+    ]),
+    # indexes for the where filters of the list queries
+    (2, [
+        'CREATE INDEX IF NOT EXISTS fish_type_idx ON Fish (type text_pattern_ops)',
+        'CREATE INDEX IF NOT EXISTS fish_color_idx ON Fish (color text_pattern_ops)',
+        'CREATE INDEX IF NOT EXISTS sample_word_idx ON Sample (word text_pattern_ops)',
+    ]),
+    # text_pattern_ops does not follow the collation, so orderBy needs its own indexes
+    (3, [
+        'CREATE INDEX IF NOT EXISTS fish_type_sort_idx ON Fish (type)',
+        'CREATE INDEX IF NOT EXISTS fish_color_sort_idx ON Fish (color)',
+        'CREATE INDEX IF NOT EXISTS sample_word_sort_idx ON Sample (word)',
+    ]),
+    # change notifications for the subscriptions
+    (4, [
+        """CREATE OR REPLACE FUNCTION notify_change() RETURNS trigger AS $$
+        DECLARE
+            changed RECORD;
+            payload TEXT;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN changed := OLD; ELSE changed := NEW; END IF;
+            payload := json_build_object('table', TG_TABLE_NAME, 'operation', TG_OP, 'id', changed.id, 'row', row_to_json(changed))::text;
+            -- a NOTIFY payload is limited to 8000 bytes: send large rows without their columns
+            IF octet_length(payload) > 7900 THEN
+                payload := json_build_object('table', TG_TABLE_NAME, 'operation', TG_OP, 'id', changed.id)::text;
+            END IF;
+            PERFORM pg_notify('changes', payload);
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql""",
+        'DROP TRIGGER IF EXISTS fish_notify_change ON Fish',
+        'CREATE TRIGGER fish_notify_change AFTER INSERT OR UPDATE OR DELETE ON Fish FOR EACH ROW EXECUTE FUNCTION notify_change()',
+        'DROP TRIGGER IF EXISTS sample_notify_change ON Sample',
+        'CREATE TRIGGER sample_notify_change AFTER INSERT OR UPDATE OR DELETE ON Sample FOR EACH ROW EXECUTE FUNCTION notify_change()',
+    ]),
+]
 
 #*Dataclasses
 @strawberry.type
@@ -46,94 +1422,353 @@ class Sample:
     id : str 
     word : str
 
+@strawberry.input
+class FishInput:
+    type: str
+    color: str
+
+@strawberry.input
+class FishWhere:
+    id: typing.Optional[NumberFilter] = None
+    type: typing.Optional[TextFilter] = None
+    color: typing.Optional[TextFilter] = None
+
+@strawberry.enum
+class FishSortColumn(enum.Enum):
+    ID = "id"
+    TYPE = "type"
+    COLOR = "color"
+
+@strawberry.input
+class FishOrder:
+    column: FishSortColumn
+    direction: SortDirection = SortDirection.ASC
+
+@strawberry.type
+class FishChange:
+    operation: str
+    id: str
+    # None when the row was too large to fit in the notification
+    fish: typing.Optional[Fish]
+
+@strawberry.input
+class SampleInput:
+    word: str
+
+@strawberry.input
+class SampleWhere:
+    id: typing.Optional[NumberFilter] = None
+    word: typing.Optional[TextFilter] = None
+
+@strawberry.enum
+class SampleSortColumn(enum.Enum):
+    ID = "id"
+    WORD = "word"
+
+@strawberry.input
+class SampleOrder:
+    column: SampleSortColumn
+    direction: SortDirection = SortDirection.ASC
+
+@strawberry.type
+class SampleChange:
+    operation: str
+    id: str
+    # None when the row was too large to fit in the notification
+    sample: typing.Optional[Sample]
+
+#*tables
+TABLES = {
+    "fish": Fish,
+    "sample": Sample,
+}
+
+RELATIONSHIP_COLUMNS = {}
+
 @strawberry.type
 class Query:
     #*graphquery
     @strawberry.field
-    def all_fish(self) -> typing.List[Fish]:
-        cursor.execute("SELECT * FROM Fish")
-        lst = cursor.fetchall()
+    async def all_fish(self, info: Info, where: typing.Optional[FishWhere] = None, order_by: typing.Optional[typing.List[FishOrder]] = None, limit: typing.Optional[int] = None) -> typing.List[Fish]:
+        columns = selected_columns(info, Fish)
+        conn = await info.context.connection()
+        cursor = conn.cursor(row_factory=dict_row)
+        clause, params = compile_where(where)
+        order, limit_params = compile_order(order_by, limit)
+        await cursor.execute(f"SELECT {', '.join(columns)} FROM Fish{clause}{order}", params + limit_params)
+        lst = await cursor.fetchall()
         fish = []
         for i in lst:
-            fish.append(Fish(id=i[0], type=i[1], color=i[2]))
+            fish.append(from_row(Fish, i))
         return fish
 
     @strawberry.field
-    def get_fish(self, id: str) -> Fish:
-        cursor.execute("SELECT * FROM Fish WHERE id = %s", (id,))
-        lst = cursor.fetchone()
-        return Fish(id=lst[0], type=lst[1], color=lst[2])
+    async def fish_connection(self, info: Info, first: int = 20, after: typing.Optional[str] = None, where: typing.Optional[FishWhere] = None) -> Connection[Fish]:
+        return await paginate(info, Fish, "Fish", first, after, where)
+
+    @strawberry.field
+    async def get_fish(self, info: Info, id: str) -> Fish:
+        lst = await get_row(info, Fish, id)
+        if lst is None:
+            return Fish(id='No Data Found',type='No Data Found', color='No Data Found')
+        return from_row(Fish, lst)
          
 
     @strawberry.field
-    def all_sample(self) -> typing.List[Sample]:
-        cursor.execute("SELECT * FROM Sample")
-        lst = cursor.fetchall()
+    async def all_sample(self, info: Info, where: typing.Optional[SampleWhere] = None, order_by: typing.Optional[typing.List[SampleOrder]] = None, limit: typing.Optional[int] = None) -> typing.List[Sample]:
+        columns = selected_columns(info, Sample)
+        conn = await info.context.connection()
+        cursor = conn.cursor(row_factory=dict_row)
+        clause, params = compile_where(where)
+        order, limit_params = compile_order(order_by, limit)
+        await cursor.execute(f"SELECT {', '.join(columns)} FROM Sample{clause}{order}", params + limit_params)
+        lst = await cursor.fetchall()
         sample = []
         for i in lst:
-            sample.append(Sample(id=i[0], word=i[1]))
+            sample.append(from_row(Sample, i))
         return sample
 
+    @strawberry.field
+    async def sample_connection(self, info: Info, first: int = 20, after: typing.Optional[str] = None, where: typing.Optional[SampleWhere] = None) -> Connection[Sample]:
+        return await paginate(info, Sample, "Sample", first, after, where)
+
 @strawberry.type
 class Mutation:
     #*graphmutation
     @strawberry.mutation
-    def create_fish(self, type: str, color: str) -> Fish:
-        cursor.execute("INSERT INTO Fish (type, color) VALUES (%s, %s) RETURNING id", (type, color))
-        conn.commit()
-        fish_id = cursor.fetchone()[0]
-        return Fish(id=fish_id,type=type, color=color)
+    async def create_fish(self, info: Info, type: str, color: str) -> Fish:
+        conn = await info.context.connection()
+        cursor = conn.cursor(row_factory=dict_row)
+        await cursor.execute("INSERT INTO Fish (type, color) VALUES (%s, %s) RETURNING id, type, color", (type, color), prepare=PREPARE_STATEMENTS)
+        return from_row(Fish, await cursor.fetchone())
+
+    @strawberry.mutation
+    async def create_fishes(self, info: Info, fishes: typing.List[FishInput]) -> typing.List[str]:
+        return await bulk_insert(info, Fish, fishes)
     
     @strawberry.mutation
-    def update_fish(self, id: str, type: str, color: str) -> Fish:
-        
-        cursor.execute("UPDATE Fish SET type=%s, color=%s WHERE id = %s", (type, color, id))
-        conn.commit()
-        return Fish(id=id,type=type, color=color)
+    async def update_fish(self, info: Info, id: str, type: str, color: str) -> Fish:
+        conn = await info.context.connection()
+        cursor = conn.cursor(row_factory=dict_row)
+        await cursor.execute("UPDATE Fish SET type=%s, color=%s WHERE id = %s RETURNING id, type, color", (type, color, id), prepare=PREPARE_STATEMENTS)
+        row = await cursor.fetchone()
+        if row is None:
+            return Fish(id='No Data Found',type='No Data Found', color='No Data Found')
+        entity_cache.invalidate("Fish", id)
+        return from_row(Fish, row)
     
     @strawberry.mutation
-    def delete_fish(self, id: str) -> Fish:
-        cursor.execute("SELECT * FROM Fish WHERE id = %s", (id,))
-        lst = cursor.fetchone()
-        if lst is None:
+    async def delete_fish(self, info: Info, id: str) -> Fish:
+        conn = await info.context.connection()
+        cursor = conn.cursor(row_factory=dict_row)
+        await cursor.execute("DELETE FROM Fish WHERE id = %s RETURNING id, type, color", (id,), prepare=PREPARE_STATEMENTS)
+        row = await cursor.fetchone()
+        if row is None:
             return Fish(id='No Data Found',type='No Data Found', color='No Data Found')
-
-        cursor.execute("DELETE FROM Fish WHERE id = %s", (id,))
-        conn.commit()
-        return Fish(id=lst[0], type=lst[1], color=lst[2])
+        entity_cache.invalidate("Fish", id)
+        return from_row(Fish, row)
      
 
     @strawberry.mutation
-    def create_sample(self, word: str) -> Sample:
-        print(word , type(word))
-        cursor.execute("INSERT INTO Sample (word) VALUES (%s) RETURNING id", (word,))
-        conn.commit()
-        samples_id = cursor.fetchone()[0]
-        return Sample(id=samples_id,word=word)
+    async def create_sample(self, info: Info, word: str) -> Sample:
+        conn = await info.context.connection()
+        cursor = conn.cursor(row_factory=dict_row)
+        await cursor.execute("INSERT INTO Sample (word) VALUES (%s) RETURNING id, word", (word,), prepare=PREPARE_STATEMENTS)
+        return from_row(Sample, await cursor.fetchone())
+
+    @strawberry.mutation
+    async def create_samples(self, info: Info, samples: typing.List[SampleInput]) -> typing.List[str]:
+        return await bulk_insert(info, Sample, samples)
 
-schema = strawberry.Schema(Query , Mutation)
+@strawberry.type
+class Subscription:
+    #*graphsubscription
+
+    @strawberry.subscription
+    async def fish_changed(self, info: Info) -> typing.AsyncGenerator[FishChange, None]:
+        async for change in change_feed.subscribe(Fish):
+            row = change.get("row")
+            yield FishChange(operation=change["operation"], id=change["id"], fish=from_row(Fish, row) if row else None)
+
+    @strawberry.subscription
+    async def sample_changed(self, info: Info) -> typing.AsyncGenerator[SampleChange, None]:
+        async for change in change_feed.subscribe(Sample):
+            row = change.get("row")
+            yield SampleChange(operation=change["operation"], id=change["id"], sample=from_row(Sample, row) if row else None)
+
+schema = strawberry.Schema(
+    Query,
+    Mutation,
+    Subscription,
+    extensions=[
+        DocumentCache(maxsize=DOCUMENT_CACHE_SIZE),
+        QueryDepthLimiter(max_depth=MAX_QUERY_DEPTH),
+        AddValidationRules([QueryCostRule]),
+        ValidationCache(maxsize=DOCUMENT_CACHE_SIZE),
+        PrometheusMetrics,
+        *([Tracing] if TRACING else []),
+    ],
+)
 
 
-graphql_app = GraphQLRouter(
+graphql_app = PersistedQueryRouter(
     schema,
+    context_getter=get_context,
 )
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    provider = configure_tracing() if TRACING else None
+    watchdog = LoopWatchdog(LOOP_STALL_MS / 1000) if LOOP_STALL_MS else None
+    if watchdog is not None:
+        watchdog.start()
+    # start serving even when the database is down: the pool keeps
+    # reconnecting and /readyz reports 503 until it is back
+    await pool.open()
+    try:
+        await pool.wait(timeout=POOL_TIMEOUT)
+        print("Connected to the PostgreSQL database")
+        async with checkout() as conn:
+            pending = await pending_migrations(conn)
+        if pending:
+            print(f"Database schema is {len(pending)} migrations behind, run 'python3 baseapi.py migrate'")
+        if ENTITY_CACHE_PREWARM and entity_cache.maxsize:
+            await prewarm_cache(ENTITY_CACHE_PREWARM)
+    except PoolTimeout:
+        print("Cannot connect to the PostgreSQL database, retrying in the background")
+    health_check = asyncio.create_task(check_pool())
+    change_feed.start()
+    yield
+    change_feed.stop()
+    health_check.cancel()
+    if watchdog is not None:
+        watchdog.stop()
+    await pool.close()
+    if provider is not None:
+        provider.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(graphql_app, prefix="/graphql")
 
+
+@app.get("/stream/{table}")
+async def stream(table: str, chunk_size: int = QueryParam(STREAM_CHUNK_SIZE, ge=1, le=STREAM_MAX_CHUNK_SIZE)):
+    if table not in TABLES:
+        raise HTTPException(status_code=404, detail=f"Unknown table {table}")
+
+    async def lines():
+        async for obj in stream_table(TABLES[table], chunk_size):
+            yield json.dumps(to_dict(obj), default=str) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.post("/import/{table}")
+async def import_table(table: str, request: Request, max_errors: int = IMPORT_MAX_ERRORS):
+    if table not in TABLES:
+        raise HTTPException(status_code=404, detail=f"Unknown table {table}")
+    ndjson = "json" in request.headers.get("content-type", "")
+    try:
+        return await copy_import(TABLES[table], request_lines(request), ndjson, max_errors)
+    except ImportAborted:
+        return JSONResponse(status_code=400, content={"detail": f"more than {max_errors} invalid rows, import rolled back"})
+
+
+@app.get("/export/{table}")
+async def export_table(table: str, format: str = "csv"):
+    if table not in TABLES:
+        raise HTTPException(status_code=404, detail=f"Unknown table {table}")
+    if format == "parquet":
+        path = await parquet_export(TABLES[table])
+        return FileResponse(path, media_type=ARROW_FORMATS[format], filename=f"{table}.parquet", background=BackgroundTask(os.unlink, path))
+    if format == "arrow":
+        return StreamingResponse(
+            arrow_export(TABLES[table]),
+            media_type=ARROW_FORMATS[format],
+            headers={"Content-Disposition": f'attachment; filename="{table}.arrows"'},
+        )
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {list(EXPORT_FORMATS) + list(ARROW_FORMATS)}")
+    return StreamingResponse(
+        copy_export(TABLES[table], format),
+        media_type=EXPORT_FORMATS[format][0],
+        headers={"Content-Disposition": f'attachment; filename="{table}.{format}"'},
+    )
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return entity_cache.stats()
+
+
+@app.get("/metrics")
+async def metrics():
+    registry = prometheus_client.REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(prometheus_client.generate_latest(registry), media_type=prometheus_client.CONTENT_TYPE_LATEST)
+
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok", "database": await ping_database()}
+
+
+@app.get("/readyz")
+async def readyz():
+    database = await ping_database()
+    stats = pool.get_stats()
+    body = {
+        "status": "ready" if database["status"] == "up" else "unavailable",
+        "database": database,
+        "pool": {key: stats.get(key, 0) for key in ("pool_size", "pool_available", "requests_waiting")},
+    }
+    return JSONResponse(body, status_code=200 if database["status"] == "up" else 503)
+
 origins = ["*"]
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_methods=["*"],
-    allow_headers=["*"], 
+    allow_headers=["*"],
 )
 
-if __name__ == "__main__": 
-    try:
-        main()
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error) 
-    uvicorn.run(app, host='0.0.0.0', port=8000)
\ No newline at end of file
+class ProductionServer(BaseApplication):
+    """Gunicorn master serving the already imported ``app`` from
+    WEB_CONCURRENCY forked uvicorn workers (uvloop + httptools). The app, the
+    schema and its caches are built once in the master and shared
+    copy-on-write; each worker opens its own connection pool in lifespan."""
+
+    def __init__(self, application, options: dict):
+        self.application = application
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["migrate"]:
+        asyncio.run(main())
+        sys.exit(0)
+    if WEB_CONCURRENCY > 1:
+        # keep the preloaded objects out of the collector so that its
+        # bookkeeping does not dirty the shared pages after fork
+        gc.freeze()
+        ProductionServer(app, {
+            "bind": "0.0.0.0:8000",
+            "workers": WEB_CONCURRENCY,
+            "worker_class": "uvicorn.workers.UvicornWorker",
+            "preload_app": True,
+            "keepalive": 5,
+        }).run()
+    else:
+        uvicorn.run(app, host='0.0.0.0', port=8000, loop="auto", http="auto")